@@ -1,54 +1,101 @@
 import os
 import re
 import time
+import random
+import threading
+import sys
 import shutil
-import langdetect
+import argparse
+import sqlite3
+import hashlib
+import gcld3
 import translatehtml
 from pathlib import Path
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import argostranslate.package
+import argostranslate.settings
 import argostranslate.translate
 from googletrans import Translator
-from bs4 import BeautifulSoup, PageElement
+from bs4 import BeautifulSoup, Doctype, NavigableString, PageElement, SoupStrainer
+
+# Google Translate client, created once per worker process by init_worker and reused across files
+_REQUEST_TIMEOUT = 10.0
+_TRANSLATOR = None
+
+# Maximum number of Google Translate requests in flight per worker process
+_MAX_CONCURRENT_REQUESTS = 4
+
+# Google Translate tolerates about 5 requests per second, shared between all worker processes
+_REQUESTS_PER_SECOND = 5
+_BACKOFF_MULTIPLIER = 2
+
+# HTML comments, compiled once instead of on every file
+_HTML_COMMENT_RE = re.compile(r"<!--[\s\S]*?-->")
+
+# Root element of RSS and Atom feeds, matched on the raw page bytes
+_FEED_RE = re.compile(rb"<(?:rss|feed)[\s>]")
+
+# Tags looked at by find_corrupt_pages, everything else is left out of its parse tree
+_CORRUPT_PAGE_STRAINER = SoupStrainer("h2")
+
+# Language detector for strings the ASCII letter ratio cannot decide on
+_LANGUAGE_DETECTOR = gcld3.NNetLanguageIdentifier(min_num_bytes=0, max_num_bytes=1000)
+
+# Devanagari script block, strings containing it are already translated to Hindi
+_DEVANAGARI_RE = re.compile(r"[\u0900-\u097f]")
+
+# SQLite cache of Google Translate results shared by all worker processes, opened by init_worker
+_CACHE_FILE = Path(__file__).parent.joinpath("translations.sqlite3")
+_CACHE_BATCH_SIZE = 100
+_TRANSLATION_CACHE = None
 
 
 def find_html_files(root_dir: Path) -> list:
-    """Find all HTML files in the root directory."""
+    """Find all HTML files in the root directory along with their sizes."""
 
     if not root_dir.is_dir():
         raise ValueError("Root directory is not a directory")
 
-    return list(root_dir.glob("**/*.html"))
+    # Walk the tree with os.scandir, is_dir() and is_file() come from the directory entry and the
+    # single stat() per HTML file gives the size reused for the empty file skip
+    html_files = []
+    directories = [root_dir]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.name.endswith(".html") and entry.is_file():
+                    html_files.append((Path(entry.path), entry.stat().st_size))
 
+    return html_files
 
-def find_corrupt_pages(file: Path) -> bool:
+
+def find_corrupt_pages(file: Path, html_data: bytes) -> bool:
     """Find corrupt pages."""
 
     try:
-        with file.open(encoding="utf-8") as html_file:
-            # Check if the page is empty
-            if os.stat(file).st_size == 0:
-                print(f"Empty HTML file: {file}")
-                return True
-
-            # Parse HTML file using BeautifulSoup
-            parsed_html = BeautifulSoup(html_file.read(), "html.parser")
-
-            # Check if the page is an XML feed
-            if parsed_html.find("rss") is not None or parsed_html.find("feed") is not None:
-                print(f"XML feed found: {file}")
-                return True
-
-            # Check if h2 header contains "Checking if the site connection is secure" text
+        # Check if the page is empty
+        if not html_data:
+            print(f"Empty HTML file: {file}")
+            return True
+
+        # Feeds declare their root element at the top of the document, a raw bytes search is enough
+        head = html_data[:8192].lower()
+        if _FEED_RE.search(head):
+            print(f"XML feed found: {file}")
+            return True
+
+        # Only pages mentioning the Cloudflare check are parsed, to confirm it is in the h2 header
+        if b"checking if the site connection is secure" in html_data.lower():
+            parsed_html = BeautifulSoup(html_data, "lxml", parse_only=_CORRUPT_PAGE_STRAINER, from_encoding="utf-8")
             h2_header = parsed_html.find("h2")
             if h2_header and "Checking if the site connection is secure" in h2_header.get_text():
                 print(f"Page blocked by Cloudflare: {file}")
                 return True
 
-            return False  # Parsing successful, file is not corrupt
-
-    except FileNotFoundError:
-        print(f"File not found: {file}")
-        return True
+        return False  # File is not corrupt
 
     except Exception as e:
         print(f"Error parsing HTML file {file}: {e}")
@@ -61,12 +108,20 @@ def remove_comment_lines(html_text: str) -> str:
     if not html_text:
         return ""
 
-    pattern = re.compile(r"<!--.*?-->", re.DOTALL | re.MULTILINE)
-    cleaned_html_text = pattern.sub("", html_text)
+    cleaned_html_text = _HTML_COMMENT_RE.sub("", html_text)
 
     return cleaned_html_text
 
 
+def latin_ratio(text: str) -> float:
+    """Ratio of ASCII letters to all letters in the text."""
+
+    letters = sum(c.isalpha() for c in text)
+    ascii_letters = sum(c.isascii() and c.isalpha() for c in text)
+
+    return ascii_letters / max(1, letters)
+
+
 def find_strings(tag: PageElement):
     """Find strings inside suitable HTML tags."""
     
@@ -82,80 +137,241 @@ def find_strings(tag: PageElement):
     if not tag.string.strip():
         return
     
-    # Check if the string is in English or Spanish language
-    try:
-        lang = langdetect.detect(tag.string)
-        if lang == "en" or lang == "es":
+    # Pure ASCII strings cannot be Hindi and are English or Spanish as long as they contain a letter,
+    # a single isascii() scan stands in for both the Devanagari and the letter ratio checks
+    if tag.string.isascii():
+        if any(c.isalpha() for c in tag.string):
             return tag
-    except:
-        pass
+        return
+    
+    # Skip strings that are already in Hindi without running language detection
+    if _DEVANAGARI_RE.search(tag.string):
+        return
+    
+    # Strings written mostly in ASCII letters are English or Spanish, only ambiguous ones need language detection
+    ratio = latin_ratio(tag.string)
+    if ratio >= 0.8:
+        return tag
+    if ratio < 0.5:
+        return
+    
+    # Check if the string is in English or Spanish language
+    result = _LANGUAGE_DETECTOR.FindLanguage(text=str(tag.string))
+    if result.is_reliable and (result.language == "en" or result.language == "es"):
+        return tag
     
     return
 
 
-def translate_strings(text: str, max_retries: int = 5, timeout: int = 3) -> str:
-    """Translate strings to Hindi using Google Translate."""
-    
-    if not text or text.isspace():
-        return ""
-    
+def open_translation_cache(cache_file: Path) -> sqlite3.Connection:
+    """Open the translation cache, creating it if it does not exist."""
+
+    conn = sqlite3.connect(cache_file, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS translations (src_hash BLOB PRIMARY KEY, src TEXT, dst TEXT)")
+
+    return conn
+
+
+def hash_string(text: str) -> bytes:
+    """Hash a source string into a translation cache key."""
+
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def get_cached_translations(conn: sqlite3.Connection, texts: list) -> dict:
+    """Look up previously translated strings in the translation cache."""
+
+    cached = {}
+    for text in texts:
+        row = conn.execute("SELECT dst FROM translations WHERE src_hash = ?", (hash_string(text),)).fetchone()
+        if row is not None:
+            cached[text] = row[0]
+
+    return cached
+
+
+def cache_translations(conn: sqlite3.Connection, translations: dict):
+    """Store new translations in the translation cache."""
+
+    rows = [(hash_string(src), src, dst) for src, dst in translations.items()]
+    for i in range(0, len(rows), _CACHE_BATCH_SIZE):
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO translations VALUES (?, ?, ?)", rows[i:i + _CACHE_BATCH_SIZE])
+
+
+def chunk_strings(texts: list, max_chars: int = 4500) -> list:
+    """Pack strings into chunks that stay under the Google Translate request size limit."""
+
+    chunks = []
+    chunk = []
+    chunk_size = 0
+    for text in texts:
+        # Account for the newline used to join the strings of a chunk
+        if chunk and chunk_size + len(text) + 1 > max_chars:
+            chunks.append(chunk)
+            chunk = []
+            chunk_size = 0
+        chunk.append(text)
+        chunk_size += len(text) + 1
+
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+
+class RateLimiter:
+    """Token bucket limiting the number of requests sent per second."""
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request is allowed to be sent."""
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve the token right away, callers arriving later wait behind this one
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+_RATE_LIMITER = RateLimiter(_REQUESTS_PER_SECOND)
+
+
+def lines_match(sources: list, translations: list) -> bool:
+    """Check that the lines of a batched translation line up with their source lines."""
+
+    if len(translations) != len(sources):
+        return False
+
+    for source, translation in zip(sources, translations):
+        # A line that came back empty was merged into a neighbour
+        if not translation.strip():
+            return False
+        # Shifted lines end up far longer or shorter than the text they are paired with
+        if len(source) >= 20 and not 0.25 <= len(translation) / len(source) <= 4:
+            return False
+
+    return True
+
+
+class TranslationError(Exception):
+    """Raised when Google Translate keeps failing after all retries."""
+
+
+def translate_strings(texts: list, max_retries: int = 3, timeout: int = 3) -> list:
+    """Translate a batch of strings to Hindi using Google Translate."""
+
+    # Whitespace is not preserved by Google Translate, normalize it so each string stays on a single line
+    lines = [" ".join(text.split()) if text else "" for text in texts]
+    to_translate = [line for line in lines if line]
+    if not to_translate:
+        return [""] * len(texts)
+
     retries = 0
-    translator = Translator()
     while retries < max_retries:
         try:
-            translation = translator.translate(text, dest="hi")
-            return translation.text
+            # Send the whole batch as one request and split the result back into lines
+            _RATE_LIMITER.acquire()
+            translation = _TRANSLATOR.translate("\n".join(to_translate), dest="hi")
+            translated_lines = translation.text.split("\n")
+            if not lines_match(to_translate, translated_lines):
+                # Line breaks were not preserved, fall back to translating strings one by one,
+                # misaligned results would otherwise end up in the translation cache for good
+                translated_lines = []
+                for line in to_translate:
+                    _RATE_LIMITER.acquire()
+                    translated_lines.append(_TRANSLATOR.translate(line, dest="hi").text)
+            translated_iter = iter(translated_lines)
+            return [next(translated_iter) if line else "" for line in lines]
         except Exception as e:
-            print(f"Error while translating retrying after {timeout} seconds.")
-            time.sleep(timeout)
             retries += 1
-    print("Maximum number of retries reached.")
-    exit()
+            if retries == max_retries:
+                break
+            # Back off exponentially with jitter so rate limited workers do not retry in lockstep
+            delay = timeout * _BACKOFF_MULTIPLIER ** (retries - 1) + random.uniform(0, timeout)
+            print(f"Error while translating retrying after {delay:.1f} seconds.")
+            time.sleep(delay)
+    raise TranslationError("Maximum number of retries reached.")
 
 
-def post_processing(file: Path):
+def post_processing(file: Path, soup: BeautifulSoup, pretty: bool = False):
     """Post-processing of translated HTML files."""
     
-    # Fixing the doctype declaration
+    # Fixing the doctype declaration, it is translated along with the page's text
     source_text = "एचटीएमएल"
-    target_text = "<!DOCTYPE html>"
-    with file.open(mode="r+", encoding="utf-8") as f:
-        file_content = f.read()
-        if source_text in file_content:
-            file_content = file_content.replace(source_text, target_text)
-            f.seek(0)
-            f.write(file_content)
-            f.truncate()
+    for element in list(soup.contents):
+        if isinstance(element, NavigableString) and source_text in element:
+            element.replace_with(Doctype("html"))
             print(f"Doctype declaration is fixed.")
-            
-    with file.open(mode="r+", encoding="utf-8") as f:
-        soup = BeautifulSoup(f, "html.parser")
-        
-        tags_to_check = ["h1", "h2", "h3", "h4", "h5", "h6", "p", "span", "a", "li", "td", "th", "title", "input", "img"]
-        
-        for tag in soup.find_all(tags_to_check):
-            filtered_tag = find_strings(tag)
-            if filtered_tag:
-                if tag.name == "input":
-                    translated_string = translate_strings(tag.get("placeholder"))
-                    print(f"Replacing {tag.get('placeholder')} --> {translated_string}")
-                    tag["placeholder"] = translated_string                
-                elif tag.name == "img":
-                    translated_string = translate_strings(tag.get("alt"))
-                    print(f"Replacing {tag.get('alt')} --> {translated_string}")
-                    tag["alt"] = translated_string
-                elif tag.string:
-                    translated_string = translate_strings(tag.string)
-                    print(f"Replacing {tag.string} --> {translated_string}")
-                    tag.string.replace_with(translated_string)
-                
-        # Prettyfying the HTML file using BeautifulSoup
-        pretty_html = soup.prettify()
-        
-        # Replace the file's content with the prettified version
-        f.seek(0)
-        f.write(pretty_html)
-        f.truncate()
+    
+    tags_to_check = ["h1", "h2", "h3", "h4", "h5", "h6", "p", "span", "a", "li", "td", "th", "title", "input", "img"]
+    
+    # Collect the strings to translate so they can be sent in batches
+    pairs = []
+    for tag in soup.find_all(tags_to_check):
+        filtered_tag = find_strings(tag)
+        if filtered_tag:
+            if tag.name == "input":
+                pairs.append((tag, tag.get("placeholder")))
+            elif tag.name == "img":
+                pairs.append((tag, tag.get("alt")))
+            elif tag.string:
+                pairs.append((tag, str(tag.string)))
+
+    # Repeated strings such as button captions are translated once per file
+    texts = list(dict.fromkeys(text for _, text in pairs))
+
+    # Reuse translations from previous files and only translate new strings
+    cached_translations = get_cached_translations(_TRANSLATION_CACHE, texts)
+    missing_texts = [text for text in texts if text not in cached_translations]
+
+    # Send the chunks concurrently so their round trips overlap
+    missing_translations = []
+    with ThreadPoolExecutor(max_workers=_MAX_CONCURRENT_REQUESTS) as executor:
+        try:
+            for translated_chunk in executor.map(translate_strings, chunk_strings(missing_texts)):
+                missing_translations.extend(translated_chunk)
+        except TranslationError:
+            # Do not keep sending the remaining chunks to an endpoint that refuses them
+            executor.shutdown(cancel_futures=True)
+            raise
+
+    new_translations = dict(zip(missing_texts, missing_translations))
+    cache_translations(_TRANSLATION_CACHE, new_translations)
+
+    translations = {**cached_translations, **new_translations}
+
+    for tag, text in pairs:
+        translated_string = translations[text]
+        print(f"Replacing {text} --> {translated_string}")
+        if tag.name == "input":
+            tag["placeholder"] = translated_string
+        elif tag.name == "img":
+            tag["alt"] = translated_string
+        else:
+            tag.string.replace_with(translated_string)
+
+    # Prettyfying is only cosmetic, keep the HTML as is unless asked for
+    output_html = soup.prettify() if pretty else str(soup)
+    
+    # Write the final HTML next to the target file and rename it into place, so an interrupted
+    # run never leaves a partial file behind that would be skipped as already translated
+    tmp_file = file.with_name(f"{file.name}.tmp")
+    tmp_file.write_text(output_html, encoding="utf-8")
+    tmp_file.replace(file)
         
     print(f"Post-processing complete for {file}")
 
@@ -165,7 +381,7 @@ def replace_images():
     replace_with = Path(__file__).parent.joinpath("target/class-central/www.classcentral.com/filesingle_index.html")
     
     with open(to_be_replaced, mode="r", encoding="utf-8") as fr:
-        soup = BeautifulSoup(fr, "html.parser")
+        soup = BeautifulSoup(fr, "lxml")
         
         for tag in soup.find_all("img"):
             tag["src"] = replace_with.joinpath(tag["src"]).relative_to(replace_with.parent)
@@ -187,7 +403,91 @@ def copy_other_files():
             print(f"Copying {src_path} --> {dest_path}")
 
 
+@lru_cache(maxsize=None)
+def install_argos_package(from_code: str, to_code: str):
+    """Download and install the Argos Translate package for a language pair."""
+
+    available_packages = argostranslate.package.get_available_packages()
+    available_package = next(x for x in available_packages if (x.from_code, x.to_code) == (from_code, to_code))
+    download_path = available_package.download()
+    argostranslate.package.install_from_path(download_path)
+
+
+@lru_cache(maxsize=None)
+def get_argos_translation(from_code: str, to_code: str):
+    """Load the Argos Translate translation for an installed language pair."""
+
+    # Get installed languages
+    installed_languages = argostranslate.translate.get_installed_languages()
+    languages_by_code = {x.code: x for x in installed_languages}
+    from_lang, to_lang = languages_by_code[from_code], languages_by_code[to_code]
+
+    return from_lang.get_translation(to_lang)
+
+
+def init_worker(from_code: str, to_code: str, workers: int):
+    """Set up the translators and the translation cache once per worker process."""
+
+    global _TRANSLATOR, _TRANSLATION_CACHE, _RATE_LIMITER
+
+    # One compute thread per model, the pool already runs one worker per CPU
+    argostranslate.settings.intra_threads = 1
+    _TRANSLATOR = Translator(timeout=_REQUEST_TIMEOUT)
+    _TRANSLATION_CACHE = open_translation_cache(_CACHE_FILE)
+    _RATE_LIMITER = RateLimiter(_REQUESTS_PER_SECOND / workers)
+    get_argos_translation(from_code, to_code)
+
+
+def process_html_file(html_file: Path, source_dir: Path, target_dir: Path, from_code: str, to_code: str, pretty: bool = False):
+    """Translate a single HTML file from the source directory into the target directory."""
+
+    print(f"Processing {html_file.name}...")
+    
+    relative_path = html_file.relative_to(source_dir)
+    target_file = target_dir.joinpath(relative_path)
+    
+    if target_file.exists():
+        print(f"File already exists: {target_file.name}")
+        return
+    
+    # Read the page once, it is shared by the corruption check and the translation
+    try:
+        html_data = html_file.read_bytes()
+    except FileNotFoundError:
+        print(f"File not found: {html_file}")
+        return
+    
+    # Check for corrupt pages
+    if find_corrupt_pages(html_file, html_data):
+        print(f"Corrupt page found: {html_file}")
+        return
+
+    # Decode the page once for translation, pages that are not valid UTF-8 are corrupt
+    try:
+        html_text = html_data.decode("utf-8")
+    except UnicodeDecodeError as e:
+        print(f"Error decoding HTML file {html_file}: {e}")
+        print(f"Corrupt page found: {html_file}")
+        return
+
+    # Translate HTML file
+    cleaned_html_text = remove_comment_lines(html_text)
+    translated_html_text = translatehtml.translate_html(get_argos_translation(from_code, to_code), cleaned_html_text)
+
+    print(f"Translated {html_file}.")
+
+    # Create the target directory if it does not exist
+    target_file.parent.mkdir(parents=True, exist_ok=True)
+    
+    # Post-processing, works on the translated soup directly and writes the final HTML to the target file
+    post_processing(target_file, translated_html_text, pretty)
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Translate the Class Central mirror to Hindi.")
+    parser.add_argument("--pretty", action="store_true", help="prettify the translated HTML files")
+    args = parser.parse_args()
+
     from_code = "en"
     to_code = "hi"
     source_dir = Path(__file__).parent.joinpath("source/class-central/www.classcentral.com/")
@@ -198,52 +498,34 @@ def main():
         target_dir.mkdir()
 
     # Download and install Argos Translate package
-    available_packages = argostranslate.package.get_available_packages()
-    available_package = list(filter(lambda x: x.from_code == from_code and x.to_code == to_code, available_packages))[0] # prettier-ignore
-    download_path = available_package.download()
-    argostranslate.package.install_from_path(download_path)
-
-    # Get installed languages
-    installed_languages = argostranslate.translate.get_installed_languages()
-    from_lang = list(filter(lambda x: x.code == from_code, installed_languages))[0]
-    to_lang = list(filter(lambda x: x.code == to_code, installed_languages))[0]
+    install_argos_package(from_code, to_code)
 
     # Find all HTML files in the root directory
-    html_files = find_html_files(source_dir)
-
-    for html_file in html_files:
-        print(f"Processing {html_file.name}...")
-        
-        relative_path = html_file.relative_to(source_dir)
-        target_file = target_dir.joinpath(relative_path)
-        
-        if target_file.exists():
-            print(f"File already exists: {target_file.name}")
-            continue
-        
-        # Check for corrupt pages
-        if find_corrupt_pages(html_file):
-            print(f"Corrupt page found: {html_file}")
+    html_files = []
+    for html_file, size in find_html_files(source_dir):
+        # Skip empty files up front without opening them
+        if size == 0:
+            print(f"Empty HTML file: {html_file}")
             continue
-
-        # Translate HTML file
-        with html_file.open(encoding="utf-8") as fr:
-            html_text = fr.read()
-            cleaned_html_text = remove_comment_lines(html_text)
-            translated_html_text = translatehtml.translate_html(from_lang.get_translation(to_lang), cleaned_html_text)
-
-        # Create the target directory if it does not exist
-        target_file.parent.mkdir(parents=True, exist_ok=True)
-        
-        # Write translated HTML to target file
-        with target_file.open(mode="w", encoding="utf-8") as fw:
-            fw.write(str(translated_html_text))
-
-        print(f"Translated {html_file}.")
-        
-        # Post-processing
-        post_processing(target_file)
+        html_files.append(html_file)
+
+    # Files are independent of each other, translate them in parallel.
+    # Argos Translate is CPU-bound so every worker is a separate process with its own model.
+    process = partial(process_html_file, source_dir=source_dir, target_dir=target_dir, from_code=from_code, to_code=to_code, pretty=args.pretty) # prettier-ignore
+    workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_worker, initargs=(from_code, to_code, workers)
+    ) as executor:
+        futures = [executor.submit(process, html_file) for html_file in html_files]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except Exception as e:
+            # Stop the whole run on the first failure instead of working through the queued files
+            print(f"Stopping, {e}")
+            executor.shutdown(cancel_futures=True)
+            sys.exit(1)
         
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()